@@ -1,7 +1,7 @@
 import logging
 logging.basicConfig(level=logging.INFO)  # 必须紧跟其后
 import asyncio
-import json
+import functools
 import os
 import time
 from datetime import datetime
@@ -12,9 +12,9 @@ from jinja2 import Environment, FileSystemLoader
 from config import configs
 import orm
 
-from web_frame import add_routes, add_static
+from web_frame import add_routes, add_static, json_dumps, json_loads
 
-from handlers import cookie2user, COOKIE_NAME
+from handlers import cookie2user, COOKIE_NAME, COOKIE_MAX_AGE
 
 
 def init_jinja2(app, **kw):
@@ -28,7 +28,9 @@ def init_jinja2(app, **kw):
         variable_start_string=kw.get('variable_start_string', '{{'),  # 变量开始标识符
         variable_end_string=kw.get('variable_end_string', '}}'),  # 变量结束标识符
         # Jinja2会在使用Template时检查模板文件的状态，如果模板有修改， 则重新加载模板。如果对性能要求较高，可以将此值设为False
-        auto_reload=kw.get('auto_reload', True)
+        # 非debug模式下关闭，省掉每次渲染时对模板文件的os.stat调用
+        auto_reload=kw.get('auto_reload', configs.debug),
+        cache_size=kw.get('cache_size', 400)  # Environment内部缓存的已编译模板数量
     )
     # 从参数中获取path字段，即模板文件的位置
     path = kw.get('path', None)
@@ -36,7 +38,7 @@ def init_jinja2(app, **kw):
     if path is None:
         path = os.path.join(os.path.dirname(
             os.path.abspath(__file__)), 'templates')
-    logging.info('set jinja2 template path: %s' % path)
+    logging.info('set jinja2 template path: %s', path)
     # Environment是Jinja2中的一个核心类，它的实例用来保存配置、全局对象，以及从本地文件系统或其它位置加载模板。
     # 这里把要加载的模板和配置传给Environment，生成Environment实例
     env = Environment(loader=FileSystemLoader(path), **options)
@@ -49,55 +51,72 @@ def init_jinja2(app, **kw):
             env.filters[name] = f
     # 给webapp设置模板
     app['__templating__'] = env
+    # 不需要自动重载时，启动阶段就把所有模板编译好放进缓存
+    if not env.auto_reload:
+        for name in env.list_templates():
+            _get_tmpl(env, name)
+
+
+# 缓存编译好的Template对象，避免每次响应都去Environment里查找模板
+@functools.lru_cache(maxsize=64)
+def _get_tmpl(env, name):
+    return env.get_template(name)
 
 # ------------------------------------------拦截器middlewares设置-------------------------
 
 
-@asyncio.coroutine
-def logger_factory(app, handler):  # 在正式处理之前打印日志
-    @asyncio.coroutine
-    def logger(request):
-        logging.info('Requst : %s, %s' % (request.method, request.path))
-        return (yield from handler(request))
+async def logger_factory(app, handler):  # 在正式处理之前打印日志
+    async def logger(request):
+        logging.info('Requst : %s, %s', request.method, request.path)
+        return await handler(request)
     return logger
 
 
-@asyncio.coroutine
-def data_factory(app, handler):
-    @asyncio.coroutine
-    def parse_data(request):
+async def data_factory(app, handler):
+    async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
-                request.__data__ = yield from request.json()
-                logging.info('request json : %s' % str(request.__data__))
+                request.__data__ = json_loads(await request.read())
+                # 请求体可能很大，只有打开DEBUG日志时才输出
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug('request json : %s', request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
-                request.__data__ = yield from request.post()
-                logging.info('request form : %s' % str(request.__data__))
-        return (yield from handler(request))
+                request.__data__ = await request.post()
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug('request form : %s', request.__data__)
+        return await handler(request)
     return parse_data
 
+# 整个请求处理过程中的SQL复用同一个数据库连接，放在auth_factory之前，这样校验cookie时查询用户也能用上
+# 放在response_factory之后，handler返回后连接就归还给连接池，套用模板和转换json时不占用连接
+
+
+async def db_session_factory(app, handler):
+    async def db_session(request):
+        async with orm.request_session():
+            return await handler(request)
+    return db_session
+
 # 是为了验证当前的这个请求用户是否在登录状态下，或是否是伪造的sha1
 
 
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
+async def auth_factory(app, handler):
+    async def auth(request):
+        logging.info('check user: %s %s', request.method, request.path)
         request.__user__ = None
         # 获取到cookie字符串
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             # 通过反向解析字符串和与数据库对比获取出user
-            user = yield from cookie2user(cookie_str)
+            user = await cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                logging.info('set current user: %s', user.email)
                 # user存在则绑定到request上，说明当前用户是合法的
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
         # 执行下一步
-        return (yield from handler(request))
+        return await handler(request)
     return auth
 
 
@@ -111,90 +130,157 @@ def auth_factory(app, handler):
 #     	response_factory在拿到经过处理后的对象，经过一系列对象类型和格式的判断，构造出正确web.Response对象，以正确的方式返回给客户端
 # 在这个过程中，我们只用关心我们的handler的处理就好了，其他的都走统一的通道，如果需要差异化处理，就在通道中选择适合的地方添加处理代码。
 # 在response_factory中应用了jinja2来套用模板
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
+# 下面按handler返回结果的类型分别构造web.Response，统一的参数为(r, request, app)
+
+
+def _handle_stream(r, request, app):
+    # 如果响应结果为web.StreamResponse类，则直接把它作为响应返回
+    return r
+
+
+def _handle_bytes(r, request, app):
+    # 如果响应结果为字节流，则把字节流塞到response的body里，设置响应类型为流类型，返回
+    resp = web.Response(body=r)
+    resp.content_type = 'application/octet-stream'
+    return resp
+
+
+def _handle_str(r, request, app):
+    # 先判断是不是需要重定向，是的话直接用重定向的地址重定向
+    if r.startswith('redirect:'):
+        return web.HTTPFound(r[9:])
+    # 不是重定向的话，把字符串当做是html代码来处理
+    resp = web.Response(body=r.encode('utf-8'))
+    resp.content_type = 'text/html;charset=utf-8'
+    return resp
+
+
+def _handle_dict(r, request, app):
+    # '__cookie__'是handler要设置的登录cookie，取出来以后不作为返回内容
+    cookie = r.pop('__cookie__', None)
+    # 先查看一下有没有'__template__'为key的值
+    template = r.get('__template__')
+    # 如果没有，说明要返回json字符串，则把字典转换为json返回，对应的response类型设为json类型
+    if template is None:
+        resp = web.Response(body=json_dumps(r))
+        resp.content_type = 'application/json;charset=utf-8'
+    else:
+        r['__user__'] = request.__user__
+        # 如果有'__template__'为key的值，则说明要套用jinja2的模板，'__template__'Key对应的为模板网页所在位置
+        env = app['__templating__']
+        # 开启了自动重载的话，每次都交给Environment去检查模板是否有修改
+        tmpl = env.get_template(template) if env.auto_reload else _get_tmpl(env, template)
+        resp = web.Response(body=tmpl.render(**r).encode('utf-8'))
+        resp.content_type = 'text/html;charset=utf-8'
+    # json和html两种响应都要带上handler设置的cookie
+    if cookie is not None:
+        resp.set_cookie(COOKIE_NAME, cookie, max_age=COOKIE_MAX_AGE, httponly=True)
+    return resp
+
+
+def _handle_int(r, request, app):
+    # 如果响应结果为int，且是合法的http状态码
+    if r >= 100 and r < 600:
+        return web.Response(r)
+
+
+def _handle_tuple(r, request, app):
+    # 如果响应结果为tuple且数量为2
+    if len(r) == 2:
+        t, m = r
+        # 如果tuple的第一个元素是int类型且在100到600之间，这里应该是认定为t为http状态码，m为错误描述
+        # 或者是服务端自己定义的错误码+描述
+        if isinstance(t, int) and t >= 100 and t < 600:
+            return web.Response(status=t, text=str(m))
+        # default: 默认直接以字符串输出
+        resp = web.Response(body=str(r).encode('utf-8'))
+        resp.content_type = 'text/plain;charset=utf-8'
+        return resp
+
+
+# 响应结果的类型 -> 处理函数，每次响应只需要按type(r)查一次字典，不用逐个isinstance判断
+# 子类(比如Model是dict的子类，web.Response是web.StreamResponse的子类)第一次出现时沿着__mro__找到处理函数，然后也记到字典里
+_RESP_DISPATCH = {
+    web.StreamResponse: _handle_stream,
+    bytes: _handle_bytes,
+    str: _handle_str,
+    dict: _handle_dict,
+    int: _handle_int,
+    tuple: _handle_tuple,
+}
+
+
+def _resolve_resp_handler(tp):
+    for base in tp.__mro__:
+        fn = _RESP_DISPATCH.get(base)
+        if fn is not None:
+            _RESP_DISPATCH[tp] = fn
+            return fn
+    return None
+
+
+async def response_factory(app, handler):
+    async def response(request):
         logging.info('Response handler...')
         # 调用相应的handler处理request
-        r = yield from handler(request)
-        logging.info('r = %s' % str(r))
-        # 如果响应结果为web.StreamResponse类，则直接把它作为响应返回
-        if isinstance(r, web.StreamResponse):
-            return r
-        # 如果响应结果为字节流，则把字节流塞到response的body里，设置响应类型为流类型，返回
-        if isinstance(r, bytes):
-            resp = web.Response(body=r)
-            resp.content_type = 'application/octet-stream'
-            return resp
-        # 如果响应结果为字符串
-        if isinstance(r, str):
-            # 先判断是不是需要重定向，是的话直接用重定向的地址重定向
-            if r.startswith('redirect:'):
-                return web.HTTPFound(r[9:])
-            # 不是重定向的话，把字符串当做是html代码来处理
-            resp = web.Response(body=r.encode('utf-8'))
-            resp.content_type = 'text/html;charset=utf-8'
-            return resp
-        # 如果响应结果为字典
-        if isinstance(r, dict):
-            # 先查看一下有没有'__template__'为key的值
-            template = r.get('__template__')
-            # 如果没有，说明要返回json字符串，则把字典转换为json返回，对应的response类型设为json类型
-            if template is None:
-                resp = web.Response(body=json.dumps(
-                    r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
-            else:
-                r['__user__'] = request.__user__
-                # 如果有'__template__'为key的值，则说明要套用jinja2的模板，'__template__'Key对应的为模板网页所在位置
-                resp = web.Response(body=app['__templating__'].get_template(
-                    template).render(**r).encode('utf-8'))
-                resp.content_type = 'text/html;charset=utf-8'
-                # 以html的形式返回
-                return resp
-        # 如果响应结果为int
-        if isinstance(r, int) and r >= 100 and r < 600:
-            return web.Response(r)
-        # 如果响应结果为tuple且数量为2
-        if isinstance(r, tuple) and len(r) == 2:
-            t, m = r
-            # 如果tuple的第一个元素是int类型且在100到600之间，这里应该是认定为t为http状态码，m为错误描述
-            # 或者是服务端自己定义的错误码+描述
-            if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(status=t, text=str(m))
-            # default: 默认直接以字符串输出
-            resp = web.Response(body=str(r).encode('utf-8'))
-            resp.content_type = 'text/plain;charset=utf-8'
-            return resp
+        r = await handler(request)
+        logging.info('r = %s', r)
+        fn = _RESP_DISPATCH.get(type(r)) or _resolve_resp_handler(type(r))
+        if fn is not None:
+            return fn(r, request, app)
     return response
 
 
+# (时间差上限, 换算单位, 显示格式)，按从小到大的顺序匹配
+_DATETIME_STEPS = (
+    (3600, 60, u'%s分钟前'),
+    (86400, 3600, u'%s小时前'),
+    (604800, 86400, u'%s天前'),
+)
+
+
 def datetime_filter(t):
     delta = int(time.time() - t)
     if delta < 60:
         return u'1分钟前'
-    if delta < 3600:
-        return u'%s分钟前' % (delta // 60)
-    if delta < 86400:
-        return u'%s小时前' % (delta // 3600)
-    if delta < 604800:
-        return u'%s天前' % (delta // 86400)
+    for limit, unit, fmt in _DATETIME_STEPS:
+        if delta < limit:
+            return fmt % (delta // unit)
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
 
-@asyncio.coroutine
-def init(loop):
+# 每个连接写缓冲区的上下限：缓冲超过上限时暂停写入，降到下限以下再恢复，限制每个连接占用的内存
+_WRITE_BUFFER_HIGH = 64 * 1024
+_WRITE_BUFFER_LOW = 16 * 1024
+
+
+class _TunedProtocol(object):
+    # 包装aiohttp生成的protocol，连接建立时设置写缓冲区上下限；TCP_NODELAY由aiohttp自己在连接建立时设置
+    # 其他事件直接使用原protocol的绑定方法，不经过__getattr__转发，每次socket事件都不多一层查找
+
+    def __init__(self, protocol):
+        self._protocol = protocol
+        self.connection_lost = protocol.connection_lost
+        self.data_received = protocol.data_received
+        self.eof_received = protocol.eof_received
+        self.pause_writing = protocol.pause_writing
+        self.resume_writing = protocol.resume_writing
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(high=_WRITE_BUFFER_HIGH, low=_WRITE_BUFFER_LOW)
+        self._protocol.connection_made(transport)
+
+
+async def init(loop):
         # 创建数据库连接池，db参数传配置文件里的配置db
-    yield from orm.create_pool(loop=loop, **configs.db)
+    await orm.create_pool(loop=loop, **configs.db)
     # middlewares设置两个中间处理函数
     # middlewares中的每个factory接受两个参数，app 和 handler(即middlewares中得下一个handler)
     # 譬如这里logger_factory的handler参数其实就是response_factory()
     # middlewares的最后一个元素的Handler会通过routes查找到相应的，其实就是routes注册的对应handler
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, response_factory, db_session_factory, auth_factory
     ])
     # 初始化jinja2模板
     init_jinja2(app, filters=dict(datetime=datetime_filter))
@@ -203,7 +289,8 @@ def init(loop):
     # 添加静态文件所在地址
     add_static(app)
     # 启动
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    handler = app.make_handler()
+    srv = await loop.create_server(lambda: _TunedProtocol(handler()), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
@@ -1,5 +1,10 @@
+from collections import deque
+
 import config_default
 
+# Dict.__getattr__中用来区分“没有这个key”和“值为None”
+_sentinel = object()
+
 # 这个类主要可以使dict对象，以object.key 形式来替代  object[key]来取值
 
 
@@ -14,37 +19,50 @@ class Dict(dict):
             self[k] = v
 
     def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
+        # 用dict.get加哨兵对象判断，不走try/except KeyError
+        v = dict.get(self, key, _sentinel)
+        if v is _sentinel:
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+        return v
 
     def __setattr__(self, key, value):
         self[key] = value
 
 # 用override的已存在配置覆盖default里配置
-# 简单地递归
+# 和toDict一样用待处理队列代替递归，队列里每一项是(合并结果, default里的dict, override里的dict)
 
 
 def merge(default, override):
     r = {}
-    for k, v in default.items():
-        if k in override:
-            if isinstance(v, dict):
-                r[k] = merge(v, override[k])
+    work = deque([(r, default, override)])
+    while work:
+        dst, d, o = work.popleft()
+        for k, v in d.items():
+            if k in o:
+                if isinstance(v, dict):
+                    dst[k] = {}
+                    work.append((dst[k], v, o[k]))
+                else:
+                    dst[k] = o[k]
             else:
-                r[k] = override[k]
-        else:
-            r[k] = v
+                dst[k] = v
     return r
 
 # 把配置文件转换为Dict类实例
+# 用一个待处理队列代替递归，每次取出一对(原dict, 新Dict)填充，遇到嵌套的dict就放回队列
 
 
 def toDict(d):
     D = Dict()
-    for k, v in d.items():
-        D[k] = toDict(v) if isinstance(v, dict) else v
+    work = deque([(d, D)])
+    while work:
+        src, dst = work.popleft()
+        for k, v in src.items():
+            if isinstance(v, dict):
+                dst[k] = Dict()
+                work.append((v, dst[k]))
+            else:
+                dst[k] = v
     return D
 
 # configs默认为默认配置
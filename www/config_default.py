@@ -1,4 +1,5 @@
 configs = {
+    'debug': True,
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
@@ -1,31 +1,33 @@
 import re
 import time
-import json
 import logging
 import hashlib
+import hmac
 import base64
-import asyncio
 import pdb
 
 from web_frame import get, post
 from aiohttp import web
 
+import orm
 from models import User, Comment, Blog, next_id
 
 from config import configs
 
-from apis import Page, APIValueError, APIResourceNotFoundError, APIError
+from apis import Page, PAGE_SIZE, APIValueError, APIResourceNotFoundError, APIError
 import markdown2
 logging.basicConfig(level=logging.DEBUG)
 
-# email的匹配正则表达式
+# email的匹配正则表达式，两个正则都只需要匹配ASCII字符，加上re.ASCII可以跳过Unicode字符表
 _RE_EMAIL = re.compile(
-    r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
+    r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$', re.ASCII)
 # 密码的匹配正则表达式
-_RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+_RE_SHA1 = re.compile(r'^[0-9a-f]{40}$', re.ASCII)
 
 COOKIE_NAME = 'awesession'
+COOKIE_MAX_AGE = 86400  # 登录cookie的有效时间，单位秒
 _COOKIE_KEY = configs.session.secret
+_COOKIE_KEY_B = _COOKIE_KEY.encode('utf-8')
 
 # 检测当前用户是不是admin用户
 
@@ -47,13 +49,41 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 按创建时间倒序取出某一页的条目，返回(Page, 条目list)
+# 条目总数和当前页的条目互不依赖，所以两条SQL并发查询；页数超出范围时查出的条目为空，和先算出Page再查询的结果一样
+
+
+async def find_page(model, page_index):
+    num, items = await orm.gather(
+        model.findNumber('count(id)'),
+        model.findAll(orderBy='created_at desc', limit=(PAGE_SIZE * (page_index - 1), PAGE_SIZE)))
+    return Page(num, page_index), items
+
 # 把存文本文件转为html格式的文本
+# 转义用的映射表，translate一次就能完成&<>三个字符的替换
+_HTML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
 
 
 def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<',
-                                                                        '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
+    lines = [s for s in text.translate(_HTML_ESCAPE_TABLE).split('\n') if s.strip()]
+    if not lines:
+        return ''
+    return '<p>' + '</p><p>'.join(lines) + '</p>'
+
+# 计算cookie中的sha1签名，签名内容为: id-passwd-expires-secret
+# 直接拼接bytes后一次算出sha1，不再先格式化字符串再encode
+
+
+def cookie_sha1(uid, passwd, expires):
+    return hashlib.sha1(b'-'.join([uid.encode('utf-8'), passwd.encode('utf-8'), expires.encode('utf-8'), _COOKIE_KEY_B])).hexdigest()
+
+# 根据email生成gravatar头像地址
+# md5在这里不用于安全目的，usedforsecurity=False可以跳过OpenSSL的FIPS检查
+
+
+def gravatar_url(email):
+    md5 = hashlib.new('md5', email.encode('utf-8'), usedforsecurity=False)
+    return 'http://www.gravatar.com/avatar/%s?d=mm&s=120' % md5.hexdigest()
 
 # 根据用户信息拼接一个cookie字符串
 
@@ -62,17 +92,14 @@ def user2cookie(user, max_age):
     # build cookie string by: id-expires-sha1
     # 过期时间是当前时间+设置的有效时间
     expires = str(int(time.time() + max_age))
-    # 构建cookie存储的信息字符串
-    s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [user.id, expires, cookie_sha1(user.id, user.passwd, expires)]
     # 用-隔开，返回
     return '-'.join(L)
 
 # 根据cookie字符串，解析出用户信息相关的
 
 
-@asyncio.coroutine
-def cookie2user(cookie_str):
+async def cookie2user(cookie_str):
     # cookie_str是空则返回
     if not cookie_str:
         return None
@@ -88,14 +115,15 @@ def cookie2user(cookie_str):
         if int(expires) < time.time():
             return None
         # 根据用户id查找库，对比有没有该用户
-        user = yield from User.find(uid)
+        user = await User.find(uid)
         # 没有该用户返回None
         if user is None:
             return None
         # 根据查到的user的数据构造一个校验sha1字符串
-        s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
+        expected = cookie_sha1(uid, user.passwd, expires)
         # 比较cookie里的sha1和校验sha1，一样的话，说明当前请求的用户是合法的
-        if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
+        # 用compare_digest做常量时间比较，避免通过响应时间猜出签名
+        if not hmac.compare_digest(sha1.encode('utf-8'), expected.encode('utf-8')):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
@@ -122,20 +150,12 @@ def cookie2user(cookie_str):
 
 
 @get('/')
-def index(*, page='1'):
+async def index(*, page='1'):
     # 获取到要展示的博客页数是第几页
     page_index = get_page_index(page)
-    # 查找博客表里的条目数
-    num = yield from Blog.findNumber('count(id)')
-    # 通过Page类来计算当前页的相关信息
-    page = Page(num, page_index)
-    # 如果表里没有条目，则不需要系那是
-    if num == 0:
-        blogs = []
-    else:
-        # 否则，根据计算出来的offset(取的初始条目index)和limit(取的条数)，来取出条目
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
-        # 返回给浏览器
+    # 查找博客表里的条目数，通过Page类来计算当前页的相关信息，同时取出当前页的条目
+    page, blogs = await find_page(Blog, page_index)
+    # 返回给浏览器
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -189,7 +209,7 @@ def signout(request):
 
 
 @post('/api/users')
-def api_register_user(*, email, name, passwd):
+async def api_register_user(*, email, name, passwd):
     # 判断name是否存在，且是否只是'\n', '\r',  '\t',  ' '，这种特殊字符
     if not name or not name.strip():
         raise APIValueError('name')
@@ -201,7 +221,7 @@ def api_register_user(*, email, name, passwd):
         raise APIValueError('passwd')
 
     # 查一下库里是否有相同的email地址，如果有的话提示用户email已经被注册过
-    users = yield from User.findAll('email=?', [email])
+    users = await User.findAll('email=?', [email])
     if len(users) > 0:
         raise APIError('register:failed', 'email', 'Email is already in use.')
 
@@ -216,61 +236,46 @@ def api_register_user(*, email, name, passwd):
 
     # 创建一个用户（密码是通过sha1加密保存）
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
-                image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest(), admin=admin)
+                image=gravatar_url(email), admin=admin)
 
 # 保存这个用户到数据库用户表
-    yield from user.save()
+    await user.save()
     logging.info('save user OK')
-    # 构建返回信息
-    r = web.Response()
-    # 添加cookie
-    r.set_cookie(COOKIE_NAME, user2cookie(
-        user, 86400), max_age=86400, httponly=True)
+    # 生成cookie，要在隐藏密码之前生成
+    cookie = user2cookie(user, COOKIE_MAX_AGE)
     # 只把要返回的实例的密码改成'******'，库里的密码依然是正确的，以保证真实的密码不会因返回而暴漏
     user.passwd = '******'
-    # 返回的是json数据，所以设置content-type为json的
-    r.content_type = 'application/json'
-    # 把对象转换成json格式返回
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
-    return r
+    # 返回dict，由response_factory统一转换成json返回，并根据'__cookie__'添加cookie
+    return dict(user, __cookie__=cookie)
 
 # 登陆请求
 
 
 @post('/api/authenticate')
-def authenticate(*, email, passwd):
+async def authenticate(*, email, passwd):
     # 如果email或passwd为空，都说明有错误
     if not email:
         raise APIValueError('email', 'Invalid email')
     if not passwd:
         raise APIValueError('passwd', 'Invalid  passwd')
     # 根据email在库里查找匹配的用户
-    users = yield from User.findAll('email=?', [email])
+    users = await User.findAll('email=?', [email])
     # 没找到用户，返回用户不存在
     if len(users) == 0:
         raise APIValueError('email', 'email not exist')
     # 取第一个查到用户，理论上就一个
     user = users[0]
     # 按存储密码的方式获取出请求传入的密码字段的sha1值
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(passwd.encode('utf-8'))
+    sha1 = hashlib.sha1(b':'.join([user.id.encode('utf-8'), passwd.encode('utf-8')]))
     # 和库里的密码字段的值作比较，一样的话认证成功，不一样的话，认证失败
     if user.passwd != sha1.hexdigest():
         raise APIValueError('passwd', 'Invalid passwd')
-    # 构建返回信息
-    r = web.Response()
-    # 添加cookie
-    r.set_cookie(COOKIE_NAME, user2cookie(
-        user, 86400), max_age=86400, httponly=True)
+    # 生成cookie，要在隐藏密码之前生成
+    cookie = user2cookie(user, COOKIE_MAX_AGE)
     # 只把要返回的实例的密码改成'******'，库里的密码依然是正确的，以保证真实的密码不会因返回而暴漏
     user.passwd = '******'
-    # 返回的是json数据，所以设置content-type为json的
-    r.content_type = 'application/json'
-    # 把对象转换成json格式返回
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
-    return r
+    # 返回dict，由response_factory统一转换成json返回，并根据'__cookie__'添加cookie
+    return dict(user, __cookie__=cookie)
 
 
 # ---------------------------------------评论管理---------------------------------------
@@ -292,19 +297,15 @@ def manage_comments(*, page='1'):
 
 
 @get('/api/comments')
-def api_comments(*, page='1'):
+async def api_comments(*, page='1'):
     # 根据page获取评论，注释可参考 index 函数的注释，不细写了
     page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    p, comments = await find_page(Comment, page_index)
     return dict(page=p, comments=comments)
 
 
 @post('/api/blogs/{id}/comments')
-def api_create_comment(id, request, *, content):
+async def api_create_comment(id, request, *, content):
     # 对某个博客发表评论
     user = request.__user__
     # 必须为登陆状态下，评论
@@ -314,7 +315,7 @@ def api_create_comment(id, request, *, content):
     if not content or not content.strip():
         raise APIValueError('content')
     # 查询一下博客id是否有对应的博客
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     # 没有的话抛出错误
     if blog is None:
         raise APIResourceNotFoundError('Blog')
@@ -322,23 +323,23 @@ def api_create_comment(id, request, *, content):
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name,
                       user_image=user.image, content=content.strip())
     # 保存到评论表里
-    yield from comment.save()
+    await comment.save()
     return comment
 
 
 @post('/api/comments/{id}/delete')
-def api_delete_comments(id, request):
+async def api_delete_comments(id, request):
     # 删除某个评论
     logging.info(id)
     # 先检查是否是管理员操作，只有管理员才有删除评论权限
     check_admin(request)
     # 查询一下评论id是否有对应的评论
-    c = yield from Comment.find(id)
+    c = await Comment.find(id)
     # 没有的话抛出错误
     if c is None:
         raise APIResourceNotFoundError('Comment')
     # 有的话删除
-    yield from c.remove()
+    await c.remove()
     return dict(id=id)
 
 
@@ -346,9 +347,9 @@ def api_delete_comments(id, request):
 
 
 @get('/show_all_users')
-def show_all_users():
+async def show_all_users():
     # 显示所有的用户
-    users = yield from User.findAll()
+    users = await User.findAll()
     logging.info('to index...')
     # return (404, 'not found')
 
@@ -359,10 +360,10 @@ def show_all_users():
 
 
 @get('/api/users')
-def api_get_users(request):
+async def api_get_users(request):
     # 返回所有的用户信息jason格式
-    users = yield from User.findAll(orderBy='created_at desc')
-    logging.info('users = %s and type = %s' % (users, type(users)))
+    users = await User.findAll(orderBy='created_at desc')
+    logging.info('users = %s and type = %s', users, type(users))
     for u in users:
         u.passwd = '******'
     return dict(users=users)
@@ -400,19 +401,15 @@ def manage_blogs(*, page='1'):
 
 
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+async def api_blogs(*, page='1'):
     # 获取博客信息
     page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    p, blogs = await find_page(Blog, page_index)
     return dict(page=p, blogs=blogs)
 
 
 @post('/api/blogs')
-def api_create_blog(request, *, name, summary, content):
+async def api_create_blog(request, *, name, summary, content):
     # 只有管理员可以写博客
     check_admin(request)
     # name，summary,content 不能为空
@@ -427,16 +424,16 @@ def api_create_blog(request, *, name, summary, content):
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name,
                 user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     # 保存
-    yield from blog.save()
+    await blog.save()
     return blog
 
 
 @get('/blog/{id}')
-def get_blog(id):
+async def get_blog(id):
     # 根据博客id查询该博客信息
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     # 根据博客id查询该条博客的评论
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     # markdown2是个扩展模块，这里把博客正文和评论套入到markdonw2中
     for c in comments:
         c.html_content = text2html(c.content)
@@ -450,30 +447,30 @@ def get_blog(id):
 
 
 @get('/api/blogs/{id}')
-def api_get_blog(*, id):
+async def api_get_blog(*, id):
     # 获取某条博客的信息
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     return blog
 
 
 @post('/api/blogs/{id}/delete')
-def api_delete_blog(id, request):
+async def api_delete_blog(id, request):
     # 删除一条博客
-    logging.info("删除博客的博客ID为：%s" % id)
+    logging.info("删除博客的博客ID为：%s", id)
     # 先检查是否是管理员操作，只有管理员才有删除评论权限
     check_admin(request)
     # 查询一下评论id是否有对应的评论
-    b = yield from Blog.find(id)
+    b = await Blog.find(id)
     # 没有的话抛出错误
     if b is None:
         raise APIResourceNotFoundError('Comment')
     # 有的话删除
-    yield from b.remove()
+    await b.remove()
     return dict(id=id)
 
 
 @post('/api/blogs/modify')
-def api_modify_blog(request, *, id, name, summary, content):
+async def api_modify_blog(request, *, id, name, summary, content):
     # 修改一条博客
     logging.info("修改的博客的博客ID为：%s", id)
     # name，summary,content 不能为空
@@ -485,13 +482,13 @@ def api_modify_blog(request, *, id, name, summary, content):
         raise APIValueError('content', 'content cannot be empty')
 
     # 获取指定id的blog数据
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     blog.name = name
     blog.summary = summary
     blog.content = content
 
     # 保存
-    yield from blog.update()
+    await blog.update()
     return blog
 
 
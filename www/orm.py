@@ -1,19 +1,21 @@
 import aiomysql		# 异步mysql驱动支持
 import logging		# 支持日志操作
 import asyncio
+import contextlib
+import contextvars
+import functools
 import pdb
 
 
 def log(sql, args=()):
     # 该函数用于打印执行的SQL语句
-    logging.info('SQL:%s' % sql)
+    logging.info('SQL:%s', sql)
 
 
-@asyncio.coroutine
-def create_pool(loop, **kw):		# 引入关键字后不用显示import asyncio了
+async def create_pool(loop, **kw):		# 引入关键字后不用显示import asyncio了
     # 该函数用于创建连接池
     global __pool  # 全局变量用于保存连接池
-    __pool = yield from aiomysql.create_pool(
+    __pool = await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),  # 默认定义host名字为localhost
         port=kw.get('port', 3306),		# 默认定义mysql的默认端口是3306
         user=kw['user'],				# user是通过关键字参数传进来的
@@ -21,61 +23,142 @@ def create_pool(loop, **kw):		# 引入关键字后不用显示import asyncio了
         db=kw['database'],                   # 数据库名字，如果做ORM测试的使用请使用db=kw['db']
         charset=kw.get('charset', 'utf8'),  # 默认数据库字符集是utf8
         autocommit=kw.get('autocommit', True),  # 默认自动提交事务
-        maxsize=kw.get('maxsize', 10),		# 连接池最多同时处理10个请求
-        minsize=kw.get('minsize', 1),		# 连接池最少1个请求
+        # 连接池最多同时处理32个请求；minsize默认和maxsize相同，启动时就把连接全部建好，
+        # 并发请求上来时不用在请求处理过程中临时建立连接，避免延迟抖动
+        maxsize=kw.get('maxsize', 32),
+        minsize=kw.get('minsize', kw.get('maxsize', 32)),
+        pool_recycle=kw.get('pool_recycle', 3600),  # 连接使用超过1小时就重建，避免拿到已被MySQL断开的连接后在请求中重连
         loop=loop		# 传递消息循环对象loop用于异步执行
     )
 
 
+# 当前请求绑定的数据库连接，由request_session()设置，没有设置的话每条SQL都单独从连接池获取连接
+_session = contextvars.ContextVar('orm_session', default=None)
+
+
+@contextlib.asynccontextmanager
+async def request_session():
+    # 在一次请求的处理过程中复用同一个数据库连接，不用每条SQL都去连接池获取和归还一次
+    # 连接在第一次执行SQL时才获取，请求里没有SQL的话不会占用连接池
+    # 注意：获取以后连接会一直占用到session结束，session里面不能再从连接池获取第二个连接，
+    # 否则并发请求多的时候，每个请求都占着一个连接等别人归还，连接池会被耗尽而死锁(见gather)
+    holder = []
+    token = _session.set(holder)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+        if holder:
+            __pool.release(holder[0])
+
+
+@contextlib.asynccontextmanager
+async def _connection():
+    # 优先使用当前请求绑定的连接
+    holder = _session.get()
+    if holder is None:
+        async with __pool.acquire() as conn:
+            yield conn
+    else:
+        if not holder:
+            holder.append(await __pool.acquire())
+        yield holder[0]
+
+
+# 把SQL中的占位符?替换成aiomysql使用的%s
+# 程序里的SQL模板数量很少且固定，缓存替换结果后同一条SQL不用每次都扫描一遍
+
+
+@functools.lru_cache(maxsize=256)
+def _translate(sql):
+    return sql.replace('?', '%s')
+
+
+async def _detached(aw):
+    # gather会把每个查询包装成单独的task运行，task里修改的contextvar不会影响到当前请求
+    _session.set(None)
+    return await aw
+
+
+async def gather(*aws):
+    # 执行多个互不依赖的查询，按传入顺序返回结果
+    # 当前请求已经占用了一个连接时，就在这个连接上依次执行：一边占着连接一边再去连接池拿连接，
+    # 并发请求多的时候会把连接池占满，所有请求都在等别人归还连接，造成死锁
+    if _session.get():
+        rs = []
+        try:
+            for aw in aws:
+                rs.append(await aw)
+        except BaseException:
+            # 出错后剩下的查询不再执行，关闭还没await的协程，避免"was never awaited"警告
+            for aw in aws[len(rs) + 1:]:
+                if asyncio.iscoroutine(aw):
+                    aw.close()
+            raise
+        return rs
+    # 没有占用连接时才并发执行。一个连接同一时间只能执行一条SQL，所以每个查询各自从连接池获取连接，
+    # 用完马上归还，也不会把连接绑定到当前请求上
+    return await asyncio.gather(*(_detached(aw) for aw in aws))
+
+
 # =============================SQL处理函数区==========================
 # select和execute方法是实现其他Model类中SQL语句都经常要用的方法，原本是全局函数，这里作为静态函数处理
 # 注意：之所以放在Model类里面作为静态函数处理是为了更好的功能内聚，便于维护，这点与廖老师的处理方式不同，请注意
 
 
-@asyncio.coroutine
-def select(sql, args, size=None):
+async def select_rows(sql, args, size=None):
     # select语句则对应该select方法,传入sql语句和参数
+    # 返回(列名tuple, 行list)，每行是一个tuple，不为每行单独构造dict，Model可以直接用它来构造实例
     log(sql, args)
-    global __pool  # 这里声明global,是为了区分赋值给同名的局部变量(这里其实可以省略，因为后面没赋值)
-
     # with语句用法可以参考我的博客：http://kaimingwan.com/post/python/pythonzhong-de-withyu-ju-shi-yong
 
-    # 异步等待连接池对象返回可以连接线程，with语句则封装了清理（关闭conn）和处理异常的工作
-    with (yield from __pool) as conn:
-        # 等待连接对象返回DictCursor可以通过dict的方式获取数据库对象，需要通过游标对象执行SQL
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        # 所有args都通过repalce方法把占位符替换成%s
-        # args是execute方法的参数
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
-        # pdb.set_trace()
-        if size:  # 如果指定要返回几行
-            rs = yield from cur.fetchmany(size)  # 从数据库获取指定的行数
-        else:       # 如果没指定返回几行，即size=None
-            rs = yield from cur.fetchall()  # 返回所有结果集
-        yield from cur.close()  # 都要异步执行
-        logging.info('rows returned: %s' % len(rs))  # 输出LOG信息
-        return rs       # 返回结果集
+    # 异步等待返回可以使用的连接，with语句则封装了清理（归还conn）和处理异常的工作
+    async with _connection() as conn:
+        # 每行结果是tuple，需要通过游标对象执行SQL
+        cur = await conn.cursor(aiomysql.Cursor)
+        # 不管执行和读取结果时是否出错或被取消，都要关闭游标读完结果，否则连接上留有未读的数据，
+        # 归还连接池(或留在请求session里)以后下一条SQL会报commands out of sync
+        try:
+            # 所有占位符都通过_translate替换成%s
+            # args是execute方法的参数
+            await cur.execute(_translate(sql), args or ())
+            # pdb.set_trace()
+            if size:  # 如果指定要返回几行
+                rs = await cur.fetchmany(size)  # 从数据库获取指定的行数
+            else:       # 如果没指定返回几行，即size=None，则返回所有结果集
+                rs = await cur.fetchall()
+            # 列名只需要从description里取一次
+            cols = tuple(d[0] for d in cur.description)
+        finally:
+            await cur.close()  # 都要异步执行
+        logging.info('rows returned: %s', len(rs))  # 输出LOG信息
+        return cols, rs       # 返回列名和结果集
+
+
+async def select(sql, args, size=None):
+    # 和select_rows一样，只是把每行结果转换成 列名->值 的dict
+    cols, rs = await select_rows(sql, args, size)
+    return [dict(zip(cols, row)) for row in rs]
 
 
-@asyncio.coroutine
-def execute(sql, args, autocommit=True):
+async def execute(sql, args, autocommit=True):
     # execute方法只返回结果数，不返回结果集,用于insert,update这些SQL语句
     log(sql)
-    with (yield from __pool) as conn:
+    async with _connection() as conn:
         if not autocommit:
-            yield from conn.begin()
+            await conn.begin()
         try:
-            cur = yield from conn.cursor()
+            cur = await conn.cursor()
             # 执行sql语句，同时替换占位符
             # pdb.set_trace()
-            yield from cur.execute(sql.replace('?', '%s'), args)
+            await cur.execute(_translate(sql), args)
             affected = cur.rowcount     # 返回受影响的行数
-            yield from cur.close()       # 关闭游标
+            await cur.close()       # 关闭游标
             if not autocommit:
-                yield from conn.commit()
+                await conn.commit()
         except BaseException as e:
             if not autocommit:
-                yield from conn.rollback()
+                await conn.rollback()
             raise e  # raise不带参数，则把此处的错误往上抛;为了方便理解还是建议加e吧
         return affected
 
@@ -96,14 +179,14 @@ class ModelMetaclass(type):
             return type.__new__(cls, name, bases, attrs)
         # 获取table名称,一般就是Model类的类名:
         tableName = attrs.get('__table__', None) or name 	# 前面get失败了就直接赋值name
-        logging.info('found model:%s (table:%s)' % (name, tableName))
+        logging.info('found model:%s (table:%s)', name, tableName)
         # 获取所有的Field和主键名
         mappings = dict() 		# 保存属性和值的k,v，
         fields = []				# 保存Model类的属性
         primaryKey = None 		# 保存Model类的主键
         for k, v in attrs.items():
             if isinstance(v, Field):  # 如果是Field类型的则加入mappings对象
-                logging.info('found mapping: %s ==> %s' % (k, v))
+                logging.info('found mapping: %s ==> %s', k, v)
                 mappings[k] = v
                 # k,v键值对全部保存到mappings中，包括主键和非主键。
                 if v.primary_key:  # 如果v是主键即primary_key=True，尝试把其赋值给primaryKey属性
@@ -119,10 +202,21 @@ class ModelMetaclass(type):
 
         for k in mappings.keys():  # 清除mappings，防止实例属性覆盖类的同名属性，造成运行时错误
             # attrs中对应的属性则需要删除。作者指的是attrs的属性和mappings中的属性发生冲突，具体原因可能需要自己实际体验下这个错误才知道
-            attrs.pop(k)
-
-        # %s占位符全部替换成具体的属性名
-        escaped_fields = list(map(lambda f: r"`%s`" % f, fields))
+            # 换成直接从dict取值的property，访问字段时不用再走__getattr__和它的异常处理
+            attrs[k] = _field_property(k)
+        # 字段的值都保存在dict里，实例不需要额外的__dict__
+        attrs['__slots__'] = ()
+        # 生成按字段名展开参数的__init__
+        attrs['__init__'] = _make_init(list(mappings.keys()))
+        # 有默认值的字段 => (默认值是否callable, 默认值)，getValueOrDefault和_save_args都用这一份
+        defaults = {k: (callable(v.default), v.default) for k, v in mappings.items() if v.default is not None}
+        attrs['__defaults__'] = defaults
+        # 生成save和update时按顺序取出所有字段值的函数，顺序和__insert__、__update__中的占位符一致
+        attrs['_save_args'] = _make_save_args(fields + [primaryKey], defaults)
+        attrs['_update_args'] = _make_update_args(fields + [primaryKey])
+
+        # 给所有属性名加上`，拼成一个字符串，select和insert语句共用
+        escaped_fields_str = ', '.join(f'`{f}`' for f in fields)
 
         # ===========初始化私有私有的特别属性===========
         attrs['__mappings__'] = mappings  # 保存属性和列的关系,赋值给特殊类变量__mappings__
@@ -133,35 +227,87 @@ class ModelMetaclass(type):
         # ===========构造默认的select,insert,update,delete语句=======
         # 这里据说不用`，在mysql里面会报错，待验证
         # 默认的select语句貌似没怎么被用到，我感觉通用性如果不好，还不如不加吧。后面就findAll方法用到了
-        attrs['__select__'] = "select `%s`,%s from `%s`" % (
-            primaryKey, ','.join(escaped_fields), tableName)
+        attrs['__select__'] = f'select `{primaryKey}`, {escaped_fields_str} from `{tableName}`'
+        # 按主键查询的语句，find每次都用，直接生成好
+        attrs['__select_by_pk__'] = f'{attrs["__select__"]} where `{primaryKey}`=?'
         # insert语句前面有3个占位符，所以从第四个%开始应该是(用于替换第一个%的值a1，替换第二个%的值a2，替换第三个%的值a3)
         # 默认想执行的应该是update tableName set 属性1=？，属性2=？，... where 主键=primray_key
         # a1是tableName没问题，a2应该是主键的属性，a3则通过匿名函数结合map将%s=?全部替换成属性名=？
         # 因此这里的匿名函数就是讲%s这个占位符替换成`属性名`=?
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(
-            map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (
-            tableName, primaryKey)
+        update_fields_str = ', '.join(f'`{mappings[f].name or f}`=?' for f in fields)
+        attrs['__update__'] = f'update `{tableName}` set {update_fields_str} where `{primaryKey}`=?'
+        attrs['__delete__'] = f'delete from `{tableName}` where `{primaryKey}`=?'
         # 第三个占位符有很多问号，为了方便就直接使用了create_ars_string函数来生成num个占位符的string
         # pdb.set_trace()
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(
-            escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        attrs['__insert__'] = f'insert into `{tableName}` ({escaped_fields_str}, `{primaryKey}`) values ({create_args_string(len(fields) + 1)})'
         return type.__new__(cls, name, bases, attrs)
 
 
 def create_args_string(num):    # 在ModelMetaclass的特殊变量中用到
 
     # insert插入属性时候，增加num个数量的占位符'?'
-    L = []
-    for n in range(num):
-        L.append('?')
-    return ', '.join(L)
+    return ', '.join(['?'] * num)
+
+
+@functools.lru_cache(maxsize=64)
+def _count_sql(table, selectField, where):
+    # findNumber用到的SQL，例如: select count(id) _num_ from `blogs` where user_id=?
+    sql = f'select {selectField} _num_ from `{table}`'
+    if where:
+        sql = f'{sql} where {where}'
+    return sql
+
+
+def _field_property(key):
+    # 字段的property，没有设置过的字段返回None
+    return property(lambda self: dict.get(self, key))
+
+
+def _make_init(keys):
+    # 按字段生成一个__init__，例如: def __init__(self, *, id=None, name=None, **kw): dict.__init__(self, kw, id=id, name=name)
+    # 每个字段都是命名关键字参数，和原来的__init__(self, **kw)一样不接受位置参数，没传的字段也会以None保存，其他关键字参数照旧保存进dict
+    src = 'def __init__(self, *, %s, **kw):\n    dict.__init__(self, kw, %s)\n' % (
+        ', '.join('%s=None' % k for k in keys), ', '.join('%s=%s' % (k, k) for k in keys))
+    ns = {}
+    exec(src, ns)
+    return ns['__init__']
+
+
+def _make_save_args(keys, defaults):
+    # 生成的函数形如:
+    # def _save_args(self):
+    #     v0 = _get(self, 'name')
+    #     if v0 is None:
+    #         v0 = _d0()
+    #         _set(self, 'name', v0)
+    #     ...
+    #     return [v0, ...]
+    # 和getValueOrDefault一样，值为None时使用字段的默认值并保存回实例；默认值是否callable取自元类生成的__defaults__
+    ns = {'_get': dict.get, '_set': dict.__setitem__}
+    lines = ['def _save_args(self):']
+    for i, k in enumerate(keys):
+        lines.append('    v%d = _get(self, %r)' % (i, k))
+        if k in defaults:
+            is_callable, ns['_d%d' % i] = defaults[k]
+            lines.append('    if v%d is None:' % i)
+            lines.append('        v%d = _d%d%s' % (i, i, '()' if is_callable else ''))
+            lines.append('        _set(self, %r, v%d)' % (k, i))
+    lines.append('    return [%s]' % ', '.join('v%d' % i for i in range(len(keys))))
+    exec('\n'.join(lines) + '\n', ns)
+    return ns['_save_args']
+
+
+def _make_update_args(keys):
+    # 生成的函数形如: def _update_args(self): return [_get(self, 'name'), ..., _get(self, 'id')]
+    ns = {'_get': dict.get}
+    exec('def _update_args(self):\n    return [%s]\n' % ', '.join('_get(self, %r)' % k for k in keys), ns)
+    return ns['_update_args']
 
 
 class Model(dict, metaclass=ModelMetaclass):
     # 继承dict是为了使用方便，例如对象实例user['id']即可轻松通过UserModel去数据库获取到id
     # 元类自然是为了封装我们之前写的具体的SQL处理函数，从数据库获取数据
+    __slots__ = ()
 
     def __init__(self, **kw):
         # 调用dict的父类__init__方法用于创建Model,super(类名，类对象)
@@ -186,110 +332,105 @@ class Model(dict, metaclass=ModelMetaclass):
 
     def getValueOrDefault(self, key):
         # 这个方法当value为None的时候能够返回默认值
-        value = getattr(self, key, None)
+        value = dict.get(self, key)
         if value is None:		# 不存在这样的值则直接返回
-            # self.__mapping__在metaclass中，用于保存不同实例属性在Model基类中的映射关系
-            field = self.__mappings__[key]
-            if field.default is not None:  # 如果实例的域存在默认值，则使用默认值
-                # field.default是callable的话则直接调用
-                value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s:%s' %
-                              (key, str(value)))
-                setattr(self, key, value)
+            # __defaults__在metaclass中生成，只包含存在默认值的域
+            default = self.__defaults__.get(key)
+            if default is not None:  # 如果实例的域存在默认值，则使用默认值
+                # 默认值是callable的话则直接调用
+                is_callable, value = default
+                if is_callable:
+                    value = value()
+                logging.debug('using default value for %s:%s', key, value)
+                dict.__setitem__(self, key, value)
         return value
 
 
 # --------------------------每个Model类的子类实例应该具备的执行SQL的方法比如save------
     @classmethod    # 类方法
-    @asyncio.coroutine
-    def findAll(cls, where=None, args=None, **kw):
-        sql = [cls.__select__]  # 获取默认的select语句
-        if where:   # 如果有where语句，则修改sql变量
-            # 这里不用协程，是因为不需要等待数据返回
-            sql.append('where')  # sql里面加上where关键字
-            sql.append(where)   # 这里的where实际上是colName='xxx'这样的条件表达式
+    async def findAll(cls, where=None, args=None, **kw):
+        # 最多只有where、order by、limit三个可选子句，直接拼接字符串，每个子句前面带上空格
+        # 这里的where实际上是colName='xxx'这样的条件表达式
+        where_clause = f' where {where}' if where else ''
         if args is None:    # 什么参数?
             args = []
 
         orderBy = kw.get('orderBy', None)    # 从kw中查看是否有orderBy属性
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        order_clause = f' order by {orderBy}' if orderBy else ''
 
         limit = kw.get('limit', None)    # mysql中可以使用limit关键字
+        limit_clause = ''
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):   # 如果是int类型则增加占位符
-                sql.append('?')
+                limit_clause = ' limit ?'
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2:   # limit可以取2个参数，表示一个范围
-                sql.append('?,?')
+                limit_clause = ' limit ?,?'
                 args.extend(limit)
             else:       # 其他情况自然是语法问题
                 raise ValueError('Invalid limit value: %s' % str(limit))
-            # 在原来默认SQL语句后面再添加语句，要加个空格
 
-        rs = yield from select(' '.join(sql), args)
-        return [cls(**r) for r in rs]   # 返回结果，结果是list对象，里面的元素是dict类型的
+        cols, rs = await select_rows(cls.__select__ + where_clause + order_clause + limit_clause, args)
+        # 返回结果，结果是list对象，里面的元素是Model实例(也是dict)
+        # 直接用列名和每行的tuple填充实例，不用先为每行构造一个dict再展开成关键字参数
+        # select出来的是全部字段，不需要再调用__init__把每个字段先设为None
+        objs = []
+        for row in rs:
+            obj = cls.__new__(cls)
+            dict.update(obj, zip(cols, row))
+            objs.append(obj)
+        return objs
 
     @classmethod
-    @asyncio.coroutine
-    def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None):
         # 获取行数
         # 这里的 _num_ 什么意思？别名？ 我估计是mysql里面一个记录实时查询结果条数的变量
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+        # where里的值都用?占位，selectField和where基本是固定的几种写法，拼好的SQL直接缓存
         # pdb.set_trace()
-        if where:
-            sql.append('where')
-            sql.append(where)   # 这里不加空格？
-        rs = yield from select(' '.join(sql), args, 1)  # size = 1
+        cols, rs = await select_rows(_count_sql(cls.__table__, selectField, where), args, 1)  # size = 1
         if len(rs) == 0:  # 结果集为0的情况
             return None
-        return rs[0]['_num_']   # 有结果则rs这个list中第一个词典元素_num_这个key的value值
+        return rs[0][0]   # 有结果则rs这个list中第一行唯一的一列，即_num_的值
 
     @classmethod
-    @asyncio.coroutine
-    def find(cls, pk):
+    async def find(cls, pk):
         # 根据主键查找
         # pk是dict对象
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        cols, rs = await select_rows(cls.__select_by_pk__, [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        obj = cls.__new__(cls)
+        dict.update(obj, zip(cols, rs[0]))
+        return obj
 
     # 这个是实例方法
-    @asyncio.coroutine
-    def save(self):
-        # arg是保存所有Model实例属性和主键的list,使用getValueOrDefault方法的好处是保存默认值
+    async def save(self):
+        # arg是保存所有Model实例属性和主键的list,_save_args和getValueOrDefault一样会使用并保存默认值
         # 将自己的fields保存进去
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
+        args = self._save_args()
         # pdb.set_trace()
-        rows = yield from execute(self.__insert__, args)  # 使用默认插入函数
+        rows = await execute(self.__insert__, args)  # 使用默认插入函数
         if rows != 1:
             # 插入失败就是rows!=1
-            logging.warn(
-                'failed to insert record: affected rows: %s' % rows)
-
-    @asyncio.coroutine
-    def update(self):
-        # 这里使用getValue说明只能更新那些已经存在的值，因此不能使用getValueOrDefault方法
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
+            logging.warning(
+                'failed to insert record: affected rows: %s', rows)
+
+    async def update(self):
+        # _update_args和getValue一样只取已经存在的值，说明只能更新那些已经存在的值，因此不能使用默认值
+        args = self._update_args()
         # pdb.set_trace()
-        rows = yield from execute(self.__update__, args)    # args是属性的list
+        rows = await execute(self.__update__, args)    # args是属性的list
         if rows != 1:
-            logging.warn(
-                'failed to update by primary key: affected rows: %s' % rows)
+            logging.warning(
+                'failed to update by primary key: affected rows: %s', rows)
 
-    @asyncio.coroutine
-    def remove(self):
+    async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         # pdb.set_trace()
-        rows = yield from execute(self.__delete__, args)
+        rows = await execute(self.__delete__, args)
         if rows != 1:
-            logging.warn(
-                'failed to remove by primary key: affected rows: %s' % rows)
+            logging.warning(
+                'failed to remove by primary key: affected rows: %s', rows)
 # =====================================属性类===============================
 
 
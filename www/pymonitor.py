@@ -3,28 +3,46 @@
 
 import os
 import sys
-import time
+import signal
+import threading
 import subprocess
 
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
 
 
 def log(s):
     print('[Monitor] %s' % s)
 
 
-class MyFileSystemEventHander(FileSystemEventHandler):
+class MyFileSystemEventHander(PatternMatchingEventHandler):
+
+    # 一次保存多个文件会连续触发多个事件，等事件停下来DEBOUNCE秒后只重启一次
+    DEBOUNCE = 0.1
 
     def __init__(self, fn):
-        super(MyFileSystemEventHander, self).__init__()
+        # 由watchdog按文件名过滤，只有.py文件的事件才会回调，__pycache__和目录事件直接忽略
+        super(MyFileSystemEventHander, self).__init__(
+            patterns=['*.py'], ignore_patterns=['*/__pycache__/*'], ignore_directories=True)
         self.restart = fn
+        self._lock = threading.Lock()
+        # 定时器在各自的线程里执行重启，已经开始执行的定时器cancel不掉，用这个锁保证同一时间只有一个重启
+        self._restart_lock = threading.Lock()
+        self._pending = None
+
+    def _do_restart(self):
+        with self._restart_lock:
+            self.restart()
 
     # 重写下方法，增加文件变动触发时记录日志
     def on_any_event(self, event):
-        if event.src_path.endswith('.py'):
-            log('Python source file changed: %s' % event.src_path)
-            self.restart()
+        log('Python source file changed: %s' % event.src_path)
+        with self._lock:
+            if self._pending:
+                self._pending.cancel()
+            self._pending = threading.Timer(self.DEBOUNCE, self._do_restart)
+            self._pending.daemon = True
+            self._pending.start()
 
 command = ['echo', 'ok']
 process = None
@@ -62,11 +80,14 @@ def start_watch(path, callback):
     observer.start()
     log('Watching directory %s...' % path)
     start_process()
-    try:
-        while True:
-            time.sleep(0.5)
-    except KeyboardInterrupt:
-        observer.stop()
+    # 主线程阻塞在Event上等待退出，不再每0.5秒醒来一次；Ctrl+C时由SIGINT处理函数唤醒
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    # Windows上没有超时的wait()不会被Ctrl+C打断，信号处理函数也就没机会执行，所以每秒醒来一次
+    timeout = 1 if sys.platform == 'win32' else None
+    while not stopped.wait(timeout):
+        pass
+    observer.stop()
     observer.join()
 
 if __name__ == '__main__':
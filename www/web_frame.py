@@ -1,16 +1,40 @@
-import asyncio
+import collections
 import os
 # python中的自省模块，类似完成Java一样的反射功能。具有类型判断、获取元信息等功能，具体建议查看下方提供的官方文档
 # https://docs.python.org/3/library/inspect.html
 import inspect
 import logging
 import functools
+import importlib
 
 from urllib import parse
 
 from aiohttp import web
 
 from apis import APIError
+
+
+def _json_default(o):
+    # 不能直接序列化的对象(比如Page)用它的__dict__代替
+    return o.__dict__
+
+
+# orjson直接输出utf-8编码的bytes，序列化速度比标准库json快很多；没有安装的话退回到标准库json
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, default=_json_default)
+
+    json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+    json_loads = json.loads
+
 # 定义一个装饰器可以把函数标记为URL处理函数
 
 # 装饰器不懂的，欢迎查看我总结的关于装饰器使用的文章：
@@ -19,14 +43,23 @@ from apis import APIError
 # --------------get和post装饰器，用于增加__method__和__route__特殊属性，分别标记GET,POST方法和path
 
 
+def _wrap(func):
+    # 协程函数直接返回本身，属性加在函数上，每次请求不用多创建一层协程
+    if inspect.iscoroutinefunction(func):
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        return func(*args, **kw)
+    return wrapper
+
+
 def get(path):
     '''
     Define decorator @get('/path')
     '''
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
+        wrapper = _wrap(func)
         # 装饰后添加__method__和__route__这两个属性
         wrapper.__method__ = 'GET'
         wrapper.__route__ = path
@@ -39,9 +72,7 @@ def post(path):
     Define decorator @post('/path')
     '''
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
+        wrapper = _wrap(func)
         wrapper.__method__ = 'POST'
         wrapper.__route__ = path
         return wrapper
@@ -56,161 +87,170 @@ def post(path):
 # VAR_KEYWORD			相当于是 **kw
 
 
-def get_required_kw_args(fn):
-
-    # 如果url处理函数需要传入关键字参数，且默认是空得话，获取这个key
-    args = []
-    params = inspect.signature(fn).parameters
-    for name, param in params.items():
-        # param.default == inspect.Parameter.empty这一句表示参数的默认值要为空
-        if param.kind == inspect.Parameter.KEYWORD_ONLY and param.default == inspect.Parameter.empty:
-            args.append(name)
-    return tuple(args)
-
-
-def get_named_kw_args(fn):
-
-    # 如果url处理函数需要传入关键字参数，获取这个key
-    args = []
-    params = inspect.signature(fn).parameters
-    for name, param in params.items():
-        if param.kind == inspect.Parameter.KEYWORD_ONLY:
-            args.append(name)
-    return tuple(args)
-
-
-def has_named_kw_args(fn):  # 判断是否有指定命名关键字参数
-    params = inspect.signature(fn).parameters
-    for name, param in params.items():
-        if param.kind == inspect.Parameter.KEYWORD_ONLY:
-            return True
-
-
-def has_var_kw_arg(fn):  # 判断是否有关键字参数，VAR_KEYWORD对应**kw
-    params = inspect.signature(fn).parameters
-    for name, param in params.items():
-        if param.kind == inspect.Parameter.VAR_KEYWORD:
-            return True
+# _analyze的分析结果：是否有任何参数、是否有request参数、是否有**kw、是否有命名关键字参数、命名关键字参数名、没有默认值的命名关键字参数名
+_ArgSpec = collections.namedtuple('_ArgSpec', [
+    'has_args', 'has_request_arg', 'has_var_kw_arg', 'has_named_kw_args', 'named_kw_args', 'required_kw_args'])
 
 
-# 判断是否存在一个参数叫做request，并且该参数要在其他普通的位置参数之后，即属于*kw或者**kw或者*或者*args之后的参数
-def has_request_arg(fn):
+# 只调用一次inspect.signature，遍历一遍参数就得到RequestHandler需要的所有信息
+# 同一个函数重复注册时直接使用缓存的结果
+@functools.lru_cache(maxsize=None)
+def _analyze(fn):
     sig = inspect.signature(fn)
-    params = sig.parameters
-    found = False
-    for name, param in params.items():
+    named_kw_args = []      # 命名关键字参数，即*或*args之后的参数
+    required_kw_args = []   # 默认值为空的命名关键字参数
+    has_var_kw_arg = False  # 是否有关键字参数，VAR_KEYWORD对应**kw
+    found = False           # 是否存在一个参数叫做request
+    for name, param in sig.parameters.items():
+        if param.kind == inspect.Parameter.KEYWORD_ONLY:
+            named_kw_args.append(name)
+            # param.default == inspect.Parameter.empty这一句表示参数的默认值要为空
+            if param.default == inspect.Parameter.empty:
+                required_kw_args.append(name)
+        elif param.kind == inspect.Parameter.VAR_KEYWORD:
+            has_var_kw_arg = True
         if name == 'request':
             found = True
             continue
-        # 只能是位置参数POSITIONAL_ONLY
+        # request参数要在其他普通的位置参数之后，即request之后只能是*args、命名关键字参数或者**kw
         if found and (param.kind != inspect.Parameter.VAR_POSITIONAL and param.kind != inspect.Parameter.KEYWORD_ONLY and param.kind != inspect.Parameter.VAR_KEYWORD):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (
                 fn.__name__, str(sig)))
-    return found
+    return _ArgSpec(bool(sig.parameters), found, has_var_kw_arg, bool(named_kw_args), tuple(named_kw_args), tuple(required_kw_args))
 
 # RequestHandler目的就是从URL函数中分析其需要接收的参数，从request中获取必要的参数，
 # 调用URL函数，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求：
 
 
+async def _read_json(request):
+    # 请求体的大小由aiohttp的client_max_size限制(默认1MB)，超过时read()直接返回413
+    params = json_loads(await request.read())  # 如果请求json数据格式
+    # 是否参数是dict格式，不是的话提示JSON BODY出错
+    if not isinstance(params, dict):
+        return web.HTTPBadRequest('JSON body must be object.')
+    return params  # 正确的话把request的参数信息给kw
+
+
+async def _read_form(request):
+    params = await request.post()  # 调用post方法，注意此处已经使用了装饰器
+    return dict(params)
+
+
+# POST提交请求的类型 => 读取参数的函数
+_CT_READERS = {
+    'application/json': _read_json,
+    'application/x-www-form-urlencoded': _read_form,
+    'multipart/form-data': _read_form,
+}
+
+
+def _make_call_impl(fn, spec):
+    # 和orm中的_make_init一样，根据处理函数的签名在注册时生成专门的调用函数，请求时不再判断签名相关的分支
+    # 例如 async def api_blogs(*, page='1') 生成的函数形如:
+    # async def _call_impl(request):
+    #     kw = None
+    #     if request.method == 'POST':
+    #         ...
+    #     if request.method == 'GET':
+    #         ...
+    #     if kw is None:
+    #         kw = dict(request.match_info)
+    #     else:
+    #         kw = {k: kw[k] for k in kw.keys() & _named}
+    #         ...
+    #     _info('call with args: %s', kw)
+    #     try:
+    #         return await _func(**kw)
+    #     except _APIError as e:
+    #         return dict(error=e.error, data=e.data, message=e.message)
+    ns = {
+        '_func': fn, '_web': web, '_APIError': APIError, '_readers': _CT_READERS,
+        '_parse_qsl': parse.parse_qsl, '_info': logging.info, '_warning': logging.warning,
+        '_named': frozenset(spec.named_kw_args), '_required': frozenset(spec.required_kw_args),
+        '_required_order': spec.required_kw_args,
+    }
+    lines = ['async def _call_impl(request):']
+    if not spec.has_args:
+        # 函数没有任何参数时，调用时不需要从request中解析参数
+        lines.append('    try:')
+        lines.append('        return await _func()')
+    else:
+        # 1.kw用于保存参数
+        # 2.有可变关键字参数或命名关键字参数时，根据是POST还是GET方法将request的参数内容保存到kw
+        # 3.如果kw为空(说明request没有传递参数)，则将match_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容给kw
+        # 4.完善request参数和必要关键字参数
+        if spec.has_var_kw_arg or spec.has_named_kw_args:
+            # POST提交请求的类型(通过content_type可以指定)可以参考我的博客：http://kaimingwan.com/post/python/postchang-jian-qing-qiu-fang-shi-qian-xi
+            # Content-Type一般的值形如 text/html;charset:utf-8; 去掉;后面的charset等参数，直接按媒体类型查表找到读取参数的函数
+            # GET方法的参数直接跟在url的?后面，parse_qsl直接返回(k, v)列表，同名参数和以前一样取第一个值，所以倒序放入dict
+            lines.extend([
+                '    kw = None',
+                "    if request.method == 'POST':",
+                '        if not request.content_type:',
+                "            return _web.HTTPBadRequest('Missing Content-Type.')",
+                "        reader = _readers.get(request.content_type.split(';', 1)[0].strip().lower())",
+                '        if reader is None:',
+                "            return _web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)",
+                '        kw = await reader(request)',
+                '        if isinstance(kw, _web.StreamResponse):',
+                '            return kw',
+                "    if request.method == 'GET':",
+                '        qs = request.query_string',
+                '        if qs:',
+                '            kw = dict(reversed(_parse_qsl(qs, True)))',
+                '    if kw is None:',
+                '        kw = dict(request.match_info)',
+                '    else:',
+            ])
+            # 当没有可变关键字参数，有命名关键字参数时候，删除所有没有命名的关键字参数
+            if not spec.has_var_kw_arg and spec.named_kw_args:
+                lines.append('        kw = {k: kw[k] for k in kw.keys() & _named}')
+            # 检查命名关键字参数的名字是否和match_info中的重复
+            lines.extend([
+                '        for k, v in request.match_info.items():',
+                '            if k in kw:',
+                "                _warning('Duplicate arg name in named arg and kw args: %s', k)",
+                '            kw[k] = v',
+            ])
+        else:
+            # 没有需要从request解析的参数，只有url中的变量部分，例如'/a/{name}/c'中的name
+            lines.append('    kw = dict(request.match_info)')
+        if spec.has_request_arg:
+            lines.append("    kw['request'] = request")
+        if spec.required_kw_args:
+            # 检查是否缺少必要关键字参数，按函数签名中的顺序报告第一个缺失的参数
+            lines.extend([
+                '    missing = _required - kw.keys()',
+                '    if missing:',
+                '        name = next(n for n in _required_order if n in missing)',
+                "        return _web.HTTPBadRequest('Missing argument: %s' % name)",
+            ])
+        lines.append("    _info('call with args: %s', kw)")
+        lines.append('    try:')
+        lines.append('        return await _func(**kw)')
+    lines.append('    except _APIError as e:')
+    lines.append('        return dict(error=e.error, data=e.data, message=e.message)')
+    exec('\n'.join(lines) + '\n', ns)
+    return ns['_call_impl']
+
+
 class RequestHandler(object):  # 初始化一个请求处理类
 
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
-
-    # __call__方法的代码逻辑:
-    # 1.定义kw对象，用于保存参数
-    # 2.判断request对象是否存在参数，如果存在则根据是POST还是GET方法将参数内容保存到kw
-    # 3.如果kw为空(说明request没有传递参数)，则将match_info列表里面的资源映射表赋值给kw；如果不为空则把命名关键字参数的内容给kw
-    # 4.完善_has_request_arg和_required_kw_args属性
-    @asyncio.coroutine
-    def __call__(self, request):
-        kw = None
-        # 确保有参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-
-            # ------阶段1：POST/GET方法下正确解析request的参数，包括位置参数和关键字参数----
-            #
-            # POST提交请求的类型(通过content_type可以指定)可以参考我的博客：http://kaimingwan.com/post/python/postchang-jian-qing-qiu-fang-shi-qian-xi
-            if request.method == 'POST':
-                # 判断是否村存在Content-Type（媒体格式类型），一般Content-Type包含的值：
-                # text/html;charset:utf-8;
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = yield from request.json()  # 如果请求json数据格式
-                    # 是否参数是dict格式，不是的话提示JSON BODY出错
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params  # 正确的话把request的参数信息给kw
-                # POST提交请求的类型
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = yield from request.post()  # 调用post方法，注意此处已经使用了装饰器
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':  # get方法比较简单，直接后面跟了string来请求服务器上的资源
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    # 该方法解析url中?后面的键值对内容保存到kw
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:  # 参数为空说明没有从Request对象中获取到必要参数
-            # Resource may have variable path also. For instance, a resource
-            # with the path '/a/{name}/c' would match all incoming requests
-            # with paths such as '/a/b/c', '/a/1/c', and '/a/etc/c'.
-
-            # A variable part is specified in the form {identifier}, where the
-            # identifier can be used later in a request handler to access the
-            # matched value for that part. This is done by looking up the
-            # identifier in the Request.match_info mapping:
-            kw = dict(**request.match_info)
-            # 此时kw指向match_info属性，一个变量标识符的名字的dict列表。Request中获取的命名关键字参数必须要在这个dict当中
-        # kw不为空时，还要判断下是可变参数还是命名关键字参数，如果是命名关键字参数，则需要remove all unamed kw，这是为啥？
-        else:
-            # 如果从Request对象中获取到参数了
-            # 当没有可变参数，有命名关键字参数时候，kw指向命名关键字参数的内容
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw: 删除所有没有命名的关键字参数
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg: 检查命名关键字参数的名字是否和match_info中的重复
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning(
-                        'Duplicate arg name in named arg and kw args: %s' % k)  # 命名参数和关键字参数有名字重复
-                kw[k] = v
-        # 如果有request这个参数，则把request对象加入kw['request']
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw: 检查是否有必要关键字参数
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if name not in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
-        try:
-            r = yield from self._func(**kw)
-            return r
-        except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+        # 签名在注册时就已经确定，按签名生成只包含需要的分支的调用函数
+        self._call_impl = _make_call_impl(fn, _analyze(fn))
+
+    async def __call__(self, request):
+        return await self._call_impl(request)
 
 
 # 添加静态页面的路径
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
     app.router.add_static('/static/', path)   # app是aiohttp库里面的对象，通过router.add_router方法可以指定处理函数。本节代码自己实现了add_router。关于更多请查看aiohttp的库文档：http://aiohttp.readthedocs.org/en/stable/web.html
-    logging.info('add static %s => %s' % ('/static/', path))
+    logging.info('add static %s => %s', '/static/', path)
 
 
 def add_route(app, fn):
@@ -221,48 +261,39 @@ def add_route(app, fn):
     path = getattr(fn, '__route__', None)
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    # 判断fn是不是协程(即@asyncio.coroutine修饰的) 并且 判断是不是fn 是不是一个生成器(generator function)
-    if not asyncio.iscoroutine(fn) and not inspect.isgeneratorfunction(fn):
-        # 都不是的话，强行修饰为协程
-        fn = asyncio.coroutine(fn)
-    logging.info('add route %s %s => %s (%s)' % (
-        method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
+    # 判断fn是不是async def定义的协程函数
+    if not inspect.iscoroutinefunction(fn):
+        # 不是的话，包装成原生协程函数
+        fn = _to_coroutine_function(fn)
+    logging.info('add route %s %s => %s (%s)',
+                 method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys()))
     # 正式注册为相应的url处理方法
     # 处理方法为RequestHandler的自省函数 '__call__'
     app.router.add_route(method, path, RequestHandler(app, fn))
 
 
+def _to_coroutine_function(fn):
+    # functools.wraps会保留__route__、__method__以及签名(__wrapped__)
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        return fn(*args, **kw)
+    return wrapper
+
+
 def add_routes(app, module_name):
 
     # 自动搜索传入的module_name的module的处理函数
-    # 检查传入的module_name是否有'.'
-    # Python rfind() 返回字符串最后一次出现的位置，如果没有匹配项则返回-1
-    n = module_name.rfind('.')
-    logging.info('n = %s', n)
-    # 没有'.',则传入的是module名
-    # __import__方法使用说明请看：http://kaimingwan.com/post/python/python-de-nei-zhi-han-shu-__import__
-    if n == (-1):
-        mod = __import__(module_name, globals(), locals())
-        logging.info('globals = %s', globals()['__name__'])
-    else:
-        # name = module_name[n+1:]
-        # mod = getattr(__import__(module_name[:n], globals(), locals(), [name]), name)
-        # 上面两行是廖大大的源代码，但是把传入参数module_name的值改为'handlers.py'的话走这里是报错的，所以改成了下面这样
-        mod = __import__(module_name[:n], globals(), locals())
+    # import_module直接返回module_name对应的模块(包括'a.b'这样的子模块)，不用像__import__那样再按'.'拆分
+    mod = importlib.import_module(module_name)
     # 遍历mod的方法和属性,主要是招处理方法
     # 由于我们定义的处理方法，被@get或@post修饰过，所以方法里会有'__method__'和'__route__'属性
-    for attr in dir(mod):
-        # 如果是以'_'开头的，一律pass，我们定义的处理方法不是以'_'开头的
-        if attr.startswith('_'):
+    # vars(mod)就是模块的__dict__，直接遍历名字和对象，不用dir()排序后再逐个getattr
+    for attr, fn in vars(mod).items():
+        # 如果是以'_'开头的或者不能调用的，一律pass，我们定义的处理方法不是以'_'开头的
+        if attr.startswith('_') or not callable(fn):
             continue
-        # 获取到非'_'开头的属性或方法
-        fn = getattr(mod, attr)
-        # 取能调用的，说明是方法
-        if callable(fn):
-            # 检测'__method__'和'__route__'属性
-            method = getattr(fn, '__method__', None)
-            path = getattr(fn, '__route__', None)
-            if method and path:
-                # 如果都有，说明使我们定义的处理方法，加到app对象里处理route中
-                add_route(app, fn)
+        # 检测'__method__'和'__route__'属性
+        if getattr(fn, '__route__', None) and getattr(fn, '__method__', None):
+            # 如果都有，说明使我们定义的处理方法，加到app对象里处理route中
+            add_route(app, fn)
 